@@ -28,6 +28,8 @@ from urllib.request import Request, urlopen
 
 from robobrowser import RoboBrowser
 
+from .profiling import Profiler, profile_modes
+
 _DIR_WISEREP = "/../sne-external-WISEREP/"
 
 # set path for new directories
@@ -61,6 +63,9 @@ with open(os.path.join(os.path.dirname(_PATH), 'wiserep_spectrum_ignore.txt'), '
         line = line.rstrip()
         wiserep_spectrum_ignore.append(line)
 
+# profiler for the current spider run; does nothing unless --profile is set
+_profiler = Profiler()
+
 
 def mkSNdir(SNname, path):
     if not os.path.exists(_PATH + path + SNname):
@@ -76,8 +81,158 @@ def rmSNdir(SNname, path):
 # update lists.json
 def updateListsJson(SNname, dict_list, list_dict, path):
     dict_list.append(SNname)
-    with open(_PATH + path + 'lists.json', 'w') as fp:
-        json.dump(list_dict, fp, indent=4)
+    with _profiler.phase('json writes'):
+        with open(_PATH + path + 'lists.json', 'w') as fp:
+            json.dump(list_dict, fp, indent=4)
+
+
+# write README.json with the metadata of SNname
+def writeReadme(SNname, SN_dict, path):
+    with _profiler.phase('json writes'):
+        with open(_PATH + path + SNname + '/README.json', 'w') as fp:
+            json.dump(SN_dict[SNname], fp, indent=4)
+
+
+# submit form and parse the returned page
+def submitForm(browser, form):
+    with _profiler.phase('form submit'):
+        browser.submit_form(form)
+    # robobrowser parses lazily, so parse here to time it separately
+    with _profiler.phase('soup parse'):
+        browser.parsed
+
+
+# download a spectrum to the SNname subdirectory
+def downloadSpectrum(url, SNname, filename, path):
+    with _profiler.phase('download'):
+        rq = Request(url)
+        res = urlopen(rq)
+        dat = open(_PATH + path + SNname + "/" + filename, 'wb')
+        dat.write(res.read())
+        dat.close()
+
+
+# remove rapid, host galaxy and older duplicate spectra of SNname
+def dedupSpectra(SNname, SN_dict, spectrum_haul, obj_host_dict, path):
+    with _profiler.phase('dedup'):
+        SN_files = deepcopy(SN_dict[SNname])
+        for filename, metadata in SN_files.items():
+            if metadata['Reduction Status'] == 'rapid':
+                del SN_dict[SNname][filename]
+                del spectrum_haul[filename]
+
+                print('\tRemoving duplicate spectrum for', SNname, '--',
+                      filename)
+                with open(_PATH + path + 'scraper-log.txt', 'a') as f:
+                    f.write('Removing duplicate spectrum for ' + SNname +
+                            ' -- ' + filename + '\n')
+
+        # remove host spectrum if it exists
+        if SNname in obj_host_dict.keys():
+            if obj_host_dict[SNname]['Filename'] in SN_dict[SNname].keys():
+                filename = obj_host_dict[SNname]['Filename']
+                del SN_dict[SNname][filename]
+
+                print('\tPurging host galaxy spectrum --', filename)
+
+        # nothing left to compare if host spectrum was the only one
+        if len(SN_dict[SNname].keys()) == 0:
+            return
+
+        last_modified = {}
+        SN_files = deepcopy(SN_dict[SNname])
+        for k, d in SN_files.items():
+            for l, e in SN_files.items():
+                aa = d['Obs. Date'] == e['Obs. Date']
+                bb = d['Instrument'] == e['Instrument']
+                cc = d['Observer'] == e['Observer']
+                dd = d['Modified By'] == 'ofer-UploadSet'
+                ee = d['Modified By'] == e['Modified By']
+                if aa and bb and cc and dd and ee and k != l:  # see 2012fs
+                    date = SN_dict[SNname][k]['Last Modified']
+                    newdate = time.strptime(date, '%Y-%m-%d')
+                    last_modified[k] = newdate
+
+                elif aa and bb and cc and k != l:  # see 2016bau
+                    date = SN_dict[SNname][k]['Last Modified']
+                    newdate = time.strptime(date, '%Y-%m-%d')
+                    last_modified[k] = newdate
+
+        if len(last_modified) <= 1:
+            print('\tPresumably no other duplicate files found for',
+                  SNname)
+            with open(_PATH + path + 'scraper-log.txt', 'a') as f:
+                f.write('Presumably no other duplicate files found for ' +
+                        SNname + '\n')
+
+        elif len(last_modified) == 2:
+            duplicate = min(last_modified, key=last_modified.get)
+            del SN_dict[SNname][duplicate]
+            del spectrum_haul[duplicate]
+
+            print('\tRemoving duplicate spectrum for', SNname, '--',
+                  duplicate)
+            with open(_PATH + path + 'scraper-log.txt', 'a') as f:
+                f.write('Removing duplicate spectrum for ' + SNname +
+                        ' -- ' + duplicate + '\n')
+
+
+# map header texts to their column indices
+def indexHeaders(headers):
+    with _profiler.phase('header indexing'):
+        return {header.text: i for i, header in enumerate(headers)}
+
+
+# check an object type against include_type, or exclude_type if none given
+def isExcludedType(SNtype, include_type):
+    return ((include_type and SNtype not in include_type) or
+            (not include_type and SNtype in exclude_type))
+
+
+# check the "No. of publicSpectra" column for an empty or zero entry
+def hasNoSpectra(num_total_spec):
+    num_total_spec = unicodedata.normalize("NFKD", num_total_spec)
+    return num_total_spec == u'  ' or num_total_spec == u' 0 '
+
+
+# pull the WISeREP OBJECTS table in bulk and return a dictionary of
+# obj_name: (Type, No. of publicSpectra), used to settle full scrapes up front
+def getObjectsTable():
+    browser = RoboBrowser(history=False, parser='lxml')
+    browser.open(_WISEREP_OBJECTS_URL)
+    form = browser.get_form(action='/objects/list')
+    form['rowslimit'] = "10000"
+    submitForm(browser, form)
+    print('\tObjects table received')
+
+    objects_table = {}
+
+    header_row = browser.find("tr", {"style": "font-weight:bold"})
+    if header_row is None:
+        return objects_table
+
+    header_idx = indexHeaders(header_row.findChildren("td"))
+    type_idx = header_idx.get('Type')
+    # publicSpectra not a typo
+    num_total_spec_idx = header_idx.get('No. of publicSpectra')
+
+    if type_idx is None or num_total_spec_idx is None:
+        return objects_table
+
+    for obj in header_row.parent.findChildren("tr", {"valign": "top"}):
+        obj_name_tag = obj.find("a", {"title": "Click to show/update"})
+        if obj_name_tag is None:
+            continue
+
+        obj_children = obj.findChildren("td")
+        if len(obj_children) <= max(type_idx, num_total_spec_idx):
+            continue
+
+        objects_table[obj_name_tag.get_text()] = (
+            obj_children[type_idx].text,
+            obj_children[num_total_spec_idx].text)
+
+    return objects_table
 
 
 def main():
@@ -124,24 +279,61 @@ def main():
         default=[],
         nargs='+',
         action='store')
+    parser.add_argument(
+        '--profile',
+        dest='profile',
+        help='Profile the run and write profile-* files to the output ' +
+        'path. "sample" (default) is cheap enough for production runs, ' +
+        '"cprofile" records every call. Allocations are only tracked ' +
+        'with --profile-interval.',
+        default=None,
+        nargs='?',
+        const='sample',
+        choices=profile_modes)
+    parser.add_argument(
+        '--profile-interval',
+        dest='profile_interval',
+        help='Track allocations with tracemalloc and take a snapshot ' +
+        'every this many objects, plus one at the end of the run. ' +
+        'Slows the run considerably. Default: 0 (disabled).',
+        default=0,
+        type=int,
+        action='store')
     args = parser.parse_args()
 
     spider(update=args.update, daysago=args.daysago, name=args.name,
-           path=args.path, include_type=args.include_type)
+           path=args.path, include_type=args.include_type,
+           profile=args.profile, profile_interval=args.profile_interval)
 
     # for debugging
     # spider(update=True, daysago=30, path=_DIR_WISEREP)
 
 
-def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=[]):
+def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=[],
+           profile=None, profile_interval=0):
+    global _profiler
+
+    if not os.path.exists(_PATH + path):
+        os.mkdir(_PATH + path)
+
+    # profiles are written even if the run fails, and later runs go back to
+    # a profiler that does nothing
+    _profiler = Profiler(profile, _PATH + path, profile_interval)
+    _profiler.start()
+    try:
+        scrapeWiserep(update=update, daysago=daysago, name=name, path=path,
+                      include_type=include_type)
+    finally:
+        _profiler.stop()
+        _profiler = Profiler()
+
+
+def scrapeWiserep(update, daysago, name, path, include_type):
     start_time = time.time()
 
     incl_type_str = 'supernovae' if not include_type else '-'.join(
         include_type)
 
-    if not os.path.exists(_PATH + path):
-        os.mkdir(_PATH + path)
-
     # dig up lists of known non-supernovae and completed events, or create if
     # it does not exist
     if os.path.exists(_PATH + path + 'lists.json'):
@@ -163,27 +355,20 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
         form = browser.get_form(action='/spectra/list')
         form['spectypeid'] = "2"  # 2 for Host spectrum
         form['rowslimit'] = "10000"
-        browser.submit_form(form)
+        submitForm(browser, form)
         print('\tHost page received')
 
         obj_host_headers = (browser.find("tr", {"style": "font-weight:bold"})
                             .findChildren("td"))
 
-        for i, header in enumerate(obj_host_headers):
-            # if header.text == 'Obj. Name':
-            #     host_obj_name_idx = i
-            if header.text == 'Spec.Program':
-                host_program_idx = i
-            if header.text == 'Instrument':
-                host_instrument_idx = i
-            if header.text == 'Observer':
-                host_observer_idx = i
-            if header.text == 'Obs. Date':
-                host_obsdate_idx = i
-            if header.text == 'Reducer':
-                host_reducer_idx = i
-            if header.text == 'Ascii FileFits  File':
-                host_filename_idx = i
+        host_header_idx = indexHeaders(obj_host_headers)
+        # host_obj_name_idx = host_header_idx.get('Obj. Name')
+        host_program_idx = host_header_idx.get('Spec.Program')
+        host_instrument_idx = host_header_idx.get('Instrument')
+        host_observer_idx = host_header_idx.get('Observer')
+        host_obsdate_idx = host_header_idx.get('Obs. Date')
+        host_reducer_idx = host_header_idx.get('Reducer')
+        host_filename_idx = host_header_idx.get('Ascii FileFits  File')
 
         obj_host_list = browser.find_all(
             "a", {"title": "Click to show/update object"})
@@ -215,6 +400,9 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
     browser.open(_WISEREP_OBJECTS_URL)
     form = browser.get_form(action='/objects/list')
 
+    # events settled from the objects table before the per-object search
+    settled = set()
+
     # ready search form with field entries to submit, depending on --update
     if browser and update:
         if daysago:
@@ -226,7 +414,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
         if name:
             form['name'] = name
         form['rowslimit'] = "10000"
-        browser.submit_form(form)
+        submitForm(browser, form)
 
         try:
             new_objs = (browser.find("tr", {"style": "font-weight:bold"})
@@ -255,14 +443,60 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
         SN_list_tags = browser.find("select",
                                     {"name": "objid"}).find_all("option")[1:]
 
+        # read type and number of public spectra for all objects at once,
+        # so that only candidates need to be searched for individually
+        print('Grabbing objects table from WISeREP')
+        objects_table = getObjectsTable()
+
+        # settle excluded types and events without spectra from the
+        # objects table, without searching for them individually.
+        # lists.json is written once afterwards instead of per object.
+        non_SN = set(list_dict['non_SN'])
+        completed = set(list_dict['completed'])
+        non_SN_txt = _PATH + path + 'non-' + incl_type_str + '.txt'
+        with open(non_SN_txt, 'a') as f_non, \
+                open(_PATH + path + 'scraper-log.txt', 'a') as f_log:
+            for item in SN_list_tags:
+                SNname = item.get_text()
+                if (SNname in non_SN or SNname in completed or
+                        SNname not in objects_table):
+                    continue
+
+                SNtype, num_total_spec = objects_table[SNname]
+                if isExcludedType(SNtype, include_type):
+                    list_dict['non_SN'].append(SNname)
+                    list_dict['completed'].append(SNname)
+                    non_SN.add(SNname)
+                    completed.add(SNname)
+                    settled.add(SNname)
+                    print(SNname, 'is a', SNtype)
+                    f_non.write(SNname + ' is a ' + SNtype + '\n')
+
+                elif hasNoSpectra(num_total_spec):
+                    mkSNdir(SNname, path)
+                    list_dict['completed'].append(SNname)
+                    completed.add(SNname)
+                    settled.add(SNname)
+                    print(SNname, 'has no spectra to collect')
+                    f_log.write('From objects table: ' + SNname +
+                                ' has no spectra to collect' + '\n')
+
+        with _profiler.phase('json writes'):
+            with open(_PATH + path + 'lists.json', 'w') as fp:
+                json.dump(list_dict, fp, indent=4)
+
     # Begin by selecting event, visiting page, and scraping.
     # SN_list = ['SN2009ip']
     # for item in SN_list:
-    for item in SN_list_tags:
+    for count_obj, item in enumerate(SN_list_tags, 1):
+        _profiler.tick(count_obj)
+
         SNname = item.get_text()
         # SNname = item
 
-        if SNname in list_dict['non_SN']:
+        if SNname in settled:
+            continue
+        elif SNname in list_dict['non_SN']:
             print(SNname, 'is not a ' + incl_type_str + ' -- Skipping')
             continue
         elif SNname in list_dict['completed']:
@@ -280,7 +514,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
 
         # set Obj Name to SNname and retrieve results page
         form['name'] = SNname
-        browser.submit_form(form)
+        submitForm(browser, form)
         print('\tPage received')
 
         # locate object header indecies (_idx)
@@ -302,17 +536,13 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
                             ' has no spectra to collect' + '\n')
             continue
 
-        for i, header in enumerate(headers):
-            if header.text == 'Obj. Name':
-                obj_name_idx = i
-            if header.text == 'IAUName':
-                iau_name_idx = i
-            if header.text == 'Redshift':
-                redshift_idx = i
-            if header.text == 'Type':
-                type_idx = i
-            if header.text == 'No. of publicSpectra':  # publicSpectra not a typo
-                num_total_spec_idx = i
+        header_idx = indexHeaders(headers)
+        obj_name_idx = header_idx.get('Obj. Name')
+        iau_name_idx = header_idx.get('IAUName')
+        redshift_idx = header_idx.get('Redshift')
+        type_idx = header_idx.get('Type')
+        # publicSpectra not a typo
+        num_total_spec_idx = header_idx.get('No. of publicSpectra')
 
         # locate objects returned -- it's not always one
         obj_list = browser.find_all("form", {"target": "new"})
@@ -370,8 +600,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
 
         # exclude non-SN
         SNtype = target[type_idx].text
-        if ((include_type and SNtype not in include_type) or
-                (not include_type and SNtype in exclude_type)):
+        if isExcludedType(SNtype, include_type):
             updateListsJson(SNname, list_dict['non_SN'], list_dict, path)
             updateListsJson(SNname, list_dict['completed'], list_dict, path)
             print('\t', SNname, 'is a', SNtype)
@@ -393,8 +622,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
 
         # second chance to exclude events without spectra
         num_total_spec = target[num_total_spec_idx].text
-        num_total_spec = unicodedata.normalize("NFKD", num_total_spec)
-        if num_total_spec == u'  ' or num_total_spec == u' 0 ':
+        if hasNoSpectra(num_total_spec):
             updateListsJson(SNname, list_dict['completed'], list_dict, path)
             print('\t', SNname, 'has no spectra to collect')
             with open(_PATH + path + 'scraper-log.txt', 'a') as f:
@@ -412,27 +640,17 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
         spec_header = browser.find(
             "tr",
             {"style": "color:black; font-size:x-small"}).findChildren("td")
-        for i, header in enumerate(spec_header):
-            if header.text == 'Spec. Prog.':
-                program_idx = i
-            if header.text == 'Instrument':
-                instrument_idx = i
-            if header.text == 'Observer':
-                observer_idx = i
-            if header.text == 'Obs.date':
-                obsdate_idx = i
-            if header.text == 'Reducer':
-                reducer_idx = i
-            if header.text == 'Ascii/Fits Files':
-                filename_idx = i
-            if header.text == 'Publish':
-                publish_idx = i
-            if header.text == 'Contrib':
-                contrib_idx = i
-            if header.text == 'Last-modified':
-                last_mod_idx = i
-            if header.text == 'Modified-by':
-                modified_by_idx = i
+        spec_header_idx = indexHeaders(spec_header)
+        program_idx = spec_header_idx.get('Spec. Prog.')
+        instrument_idx = spec_header_idx.get('Instrument')
+        observer_idx = spec_header_idx.get('Observer')
+        obsdate_idx = spec_header_idx.get('Obs.date')
+        reducer_idx = spec_header_idx.get('Reducer')
+        filename_idx = spec_header_idx.get('Ascii/Fits Files')
+        publish_idx = spec_header_idx.get('Publish')
+        contrib_idx = spec_header_idx.get('Contrib')
+        last_mod_idx = spec_header_idx.get('Last-modified')
+        modified_by_idx = spec_header_idx.get('Modified-by')
 
         # build SN_dict and locate ascii files on search results page
         # associated with SNname
@@ -508,8 +726,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
                 f.write('Not collecting spectra of ' + SNname + ' at this time'
                         + '\n')
 
-            with open(_PATH + path + SNname + '/README.json', 'w') as fp:
-                json.dump(SN_dict[SNname], fp, indent=4)
+            writeReadme(SNname, SN_dict, path)
 
             updateListsJson(SNname, list_dict['completed'], list_dict, path)
             continue
@@ -545,16 +762,11 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
                           '-- see sne-external-spectra/donations')
                     continue
                 else:
-                    rq = Request(url)
-                    res = urlopen(rq)
-                    dat = open(_PATH + path + SNname + "/" + filename, 'wb')
-                    dat.write(res.read())
-                    dat.close()
+                    downloadSpectrum(url, SNname, filename, path)
 
             # add README for basic metadata to SNname subdirectory
             print('\tWriting README')
-            with open(_PATH + path + SNname + '/README.json', 'w') as fp:
-                json.dump(SN_dict[SNname], fp, indent=4)
+            writeReadme(SNname, SN_dict, path)
 
             updateListsJson(SNname, list_dict['completed'], list_dict, path)
 
@@ -564,25 +776,7 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
             # os.mkdir(_PATH+path+SNname)
             # mkSNdir(SNname, path)
 
-            SN_files = deepcopy(SN_dict[SNname])
-            for filename, metadata in SN_files.items():
-                if metadata['Reduction Status'] == 'rapid':
-                    del SN_dict[SNname][filename]
-                    del spectrum_haul[filename]
-
-                    print('\tRemoving duplicate spectrum for', SNname, '--',
-                          filename)
-                    with open(_PATH + path + 'scraper-log.txt', 'a') as f:
-                        f.write('Removing duplicate spectrum for ' + SNname +
-                                ' -- ' + filename + '\n')
-
-            # remove host spectrum if it exists
-            if SNname in obj_host_dict.keys():
-                if obj_host_dict[SNname]['Filename'] in SN_dict[SNname].keys():
-                    filename = obj_host_dict[SNname]['Filename']
-                    del SN_dict[SNname][filename]
-
-                    print('\tPurging host galaxy spectrum --', filename)
+            dedupSpectra(SNname, SN_dict, spectrum_haul, obj_host_dict, path)
 
             # need to continue to next supernova if host spectrum was only one
             if len(SN_dict[SNname].keys()) == 0:
@@ -594,43 +788,6 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
                                 path)
                 continue
 
-            last_modified = {}
-            SN_files = deepcopy(SN_dict[SNname])
-            for k, d in SN_files.items():
-                for l, e in SN_files.items():
-                    aa = d['Obs. Date'] == e['Obs. Date']
-                    bb = d['Instrument'] == e['Instrument']
-                    cc = d['Observer'] == e['Observer']
-                    dd = d['Modified By'] == 'ofer-UploadSet'
-                    ee = d['Modified By'] == e['Modified By']
-                    if aa and bb and cc and dd and ee and k != l:  # see 2012fs
-                        date = SN_dict[SNname][k]['Last Modified']
-                        newdate = time.strptime(date, '%Y-%m-%d')
-                        last_modified[k] = newdate
-
-                    elif aa and bb and cc and k != l:  # see 2016bau
-                        date = SN_dict[SNname][k]['Last Modified']
-                        newdate = time.strptime(date, '%Y-%m-%d')
-                        last_modified[k] = newdate
-
-            if len(last_modified) <= 1:
-                print('\tPresumably no other duplicate files found for',
-                      SNname)
-                with open(_PATH + path + 'scraper-log.txt', 'a') as f:
-                    f.write('Presumably no other duplicate files found for ' +
-                            SNname + '\n')
-
-            elif len(last_modified) == 2:
-                duplicate = min(last_modified, key=last_modified.get)
-                del SN_dict[SNname][duplicate]
-                del spectrum_haul[duplicate]
-
-                print('\tRemoving duplicate spectrum for', SNname, '--',
-                      duplicate)
-                with open(_PATH + path + 'scraper-log.txt', 'a') as f:
-                    f.write('Removing duplicate spectrum for ' + SNname +
-                            ' -- ' + duplicate + '\n')
-
             count = 1
             for filename, url in spectrum_haul.items():
                 print('\tDownloading', count, 'of', len(SN_dict[SNname]),
@@ -641,18 +798,13 @@ def spider(update=False, daysago=30, name=None, path=_DIR_WISEREP, include_type=
                           '-- see sne-external-spectra/donations')
                     continue
                 else:
-                    rq = Request(url)
-                    res = urlopen(rq)
-                    dat = open(_PATH + path + SNname + "/" + filename, 'wb')
-                    dat.write(res.read())
-                    dat.close()
+                    downloadSpectrum(url, SNname, filename, path)
 
                 count += 1
 
             # add README for basic metadata to SNname subdirectory
             print('\tWriting README')
-            with open(_PATH + path + SNname + '/README.json', 'w') as fp:
-                json.dump(SN_dict[SNname], fp, indent=4)
+            writeReadme(SNname, SN_dict, path)
 
             updateListsJson(SNname, list_dict['completed'], list_dict, path)
 
@@ -0,0 +1,141 @@
+"""Profiling hooks for spider runs.
+
+Times are attributed to named phases (form submit, soup parse, ...). The
+``sample`` mode walks the interpreter stack on a CPU-time timer signal and
+is cheap enough to leave on during update runs; the ``cprofile`` mode
+records every call with cProfile. Allocation tracking is opt-in, since
+tracemalloc slows parsing-heavy code several times over: with a nonzero
+``interval``, snapshots are dumped every ``interval`` objects and once
+when the profiler stops. All output lands in the output path:
+
+    profile-phases.collapsed     wall time per phase, in microseconds
+    profile-cpu.collapsed        sampled stacks (``sample`` mode)
+    profile-cpu.pstats           cProfile stats (``cprofile`` mode)
+    profile-mem-<count>.snapshot tracemalloc snapshots
+    profile-mem-end.snapshot     tracemalloc snapshot at the end of the run
+
+The collapsed-stack files can be passed directly to flamegraph.pl.
+"""
+
+import cProfile
+import os
+import signal
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+profile_modes = ['sample', 'cprofile']
+
+# sampling period of the CPU timer in seconds
+_SAMPLE_PERIOD = 0.01
+
+
+class Profiler(object):
+    """Collects phase timings, CPU profiles and allocation snapshots.
+
+    A Profiler created without a mode does nothing, so the hooks can stay
+    in place for unprofiled runs.
+    """
+
+    def __init__(self, mode=None, outdir='', interval=0):
+        if mode is not None and mode not in profile_modes:
+            raise ValueError('Unknown profile mode: ' + str(mode))
+        if mode == 'sample' and not hasattr(signal, 'setitimer'):
+            raise ValueError('Sampling profiles need signal.setitimer; '
+                             'use the cprofile mode instead')
+
+        self.mode = mode
+        self.outdir = outdir
+        self.interval = interval
+
+        self._phases = []
+        self._child_times = []
+        self._phase_times = defaultdict(float)
+        self._samples = defaultdict(int)
+        self._cprofile = None
+
+    def start(self):
+        if not self.mode:
+            return
+
+        if self.interval:
+            tracemalloc.start()
+
+        if self.mode == 'cprofile':
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        elif self.mode == 'sample':
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, _SAMPLE_PERIOD,
+                             _SAMPLE_PERIOD)
+
+    def stop(self):
+        if not self.mode:
+            return
+
+        if self.mode == 'cprofile':
+            self._cprofile.disable()
+            self._cprofile.dump_stats(
+                os.path.join(self.outdir, 'profile-cpu.pstats'))
+        elif self.mode == 'sample':
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+            self._writeCollapsed('profile-cpu.collapsed', self._samples)
+
+        self._writeCollapsed(
+            'profile-phases.collapsed',
+            {k: int(v * 1e6) for k, v in self._phase_times.items()})
+
+        if self.interval:
+            tracemalloc.take_snapshot().dump(
+                os.path.join(self.outdir, 'profile-mem-end.snapshot'))
+            tracemalloc.stop()
+
+        print('\tProfile written to', self.outdir)
+
+    @contextmanager
+    def phase(self, name):
+        """Attribute the time spent in the enclosed block to ``name``."""
+        if not self.mode:
+            yield
+            return
+
+        self._phases.append(name)
+        self._child_times.append(0.0)
+        stack = ';'.join(['spider'] + self._phases)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            # collapsed stacks hold self time; nested phases report their own
+            self._phase_times[stack] += elapsed - self._child_times.pop()
+            self._phases.pop()
+            if self._child_times:
+                self._child_times[-1] += elapsed
+
+    def tick(self, count):
+        """Dump an allocation snapshot every ``interval`` objects."""
+        if not self.mode or not self.interval or count % self.interval:
+            return
+
+        tracemalloc.take_snapshot().dump(os.path.join(
+            self.outdir, 'profile-mem-' + str(count) + '.snapshot'))
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(code.co_name + ' (' +
+                         os.path.basename(code.co_filename) + ':' +
+                         str(code.co_firstlineno) + ')')
+            frame = frame.f_back
+        stack.reverse()
+
+        self._samples[';'.join(['spider'] + self._phases + stack)] += 1
+
+    def _writeCollapsed(self, filename, counts):
+        with open(os.path.join(self.outdir, filename), 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write(stack + ' ' + str(count) + '\n')